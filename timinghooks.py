@@ -2,8 +2,17 @@
 A class to support placement of timing points in a Python application.
 """
 import time
+import array
 import threading
-import contextlib
+import collections
+import functools
+import gc
+import operator
+import os
+import pickle
+import subprocess
+import sys
+import weakref
 import unittest
 
 try:
@@ -15,16 +24,221 @@ except ImportError:
 __version__ = "1.0.0"
 
 
+def getClockFunc(clock):
+    """
+    Return the function used to read the current time for the given
+    clock name. Valid names are:
+
+        'perf'
+            time.perf_counter(), monotonic with the highest available
+            resolution. This is the default.
+        'coarse'
+            The Linux CLOCK_MONOTONIC_COARSE clock, which is read from a
+            kernel-maintained value without a system call, and so is much
+            cheaper to read. However, its resolution is only the kernel
+            tick, typically 1-4 milliseconds, so it is only suitable when
+            a very large number of short intervals are being timed, and
+            only their aggregate is of interest. On platforms without
+            this clock, falls back to time.perf_counter().
+
+    """
+    if clock == 'perf':
+        clockFunc = time.perf_counter
+    elif clock == 'coarse':
+        if hasattr(time, 'CLOCK_MONOTONIC_COARSE'):
+            clockFunc = functools.partial(time.clock_gettime,
+                time.CLOCK_MONOTONIC_COARSE)
+        else:
+            clockFunc = time.perf_counter
+    else:
+        raise ValueError("Unknown clock '{}'".format(clock))
+    return clockFunc
+
+
+def makeSampledClock(clockFunc, samplingHz):
+    """
+    Start a daemon thread which reads the given clock function samplingHz
+    times per second, storing the value in a shared variable. Returns a
+    tuple of
+        (readFunc, stopEvent)
+    where readFunc() returns the most recently stored time, without
+    reading the clock itself, and setting stopEvent will stop the thread.
+
+    """
+    if samplingHz <= 0:
+        raise ValueError("samplingHz must be positive, not {}".format(
+            samplingHz))
+
+    current = [clockFunc()]
+    stopEvent = threading.Event()
+    period = 1.0 / samplingHz
+
+    def sampler():
+        while not stopEvent.is_set():
+            current[0] = clockFunc()
+            time.sleep(period)
+
+    threading.Thread(target=sampler, daemon=True).start()
+    readFunc = functools.partial(operator.getitem, current, 0)
+    return (readFunc, stopEvent)
+
+
+def summarizeDurations(intervals):
+    """
+    Calculate summary statistics for a numpy array of durations, in a
+    form which can be compiled with numba (see getSummaryKernel()).
+    Returns a tuple of
+        (total, min, max, mean, lowerq, median, upperq)
+
+    The total, min and max are found in a single pass. The quartiles are
+    interpolated in the same way as numpy.percentile(), after a single
+    partition of a copy of the array.
+
+    An empty array gives a total of zero, and NaN for everything else.
+    It must not raise an exception, as the numba kernel calls it in a
+    parallel loop, where exceptions are not reliably propagated.
+
+    """
+    n = intervals.size
+    if n == 0:
+        return (0.0, numpy.nan, numpy.nan, numpy.nan, numpy.nan, numpy.nan,
+            numpy.nan)
+
+    tot = 0.0
+    minVal = intervals[0]
+    maxVal = intervals[0]
+    for i in range(n):
+        val = intervals[i]
+        tot += val
+        if val < minVal:
+            minVal = val
+        if val > maxVal:
+            maxVal = val
+    meanVal = tot / n
+
+    # Positions of the quartiles, and the elements either side of each
+    pos = numpy.array([0.25, 0.5, 0.75]) * (n - 1)
+    lower = numpy.floor(pos).astype(numpy.int64)
+    upper = numpy.minimum(lower + 1, n - 1)
+    kth = numpy.unique(numpy.concatenate((lower, upper)))
+    part = numpy.partition(intervals, kth)
+    frac = pos - lower
+    quartiles = part[lower] + (part[upper] - part[lower]) * frac
+
+    return (tot, minVal, maxVal, meanVal, quartiles[0], quartiles[1],
+        quartiles[2])
+
+
+def summarizeDurationsNumpy(arrays):
+    """
+    Calculate summary statistics for each of a list of numpy arrays of
+    durations, using only numpy. Used when numba is not available.
+    Returns a list with a tuple for each array, as for
+    summarizeDurations(). None of the arrays may be empty.
+
+    Where the arrays are of similar lengths, they are packed into the rows
+    of a single 2-d array, padded with NaN, so that each statistic is
+    calculated for all of them with one numpy call. This avoids paying
+    the overhead of each numpy call for every timer. If the lengths vary
+    too much, the padding would cost more than it saves, so each array is
+    done separately instead.
+
+    """
+    if len(arrays) == 0:
+        return []
+
+    lengths = numpy.array([intervals.size for intervals in arrays])
+    maxLen = lengths.max()
+    if len(arrays) * maxLen > 2 * lengths.sum():
+        stats = []
+        for intervals in arrays:
+            tot = intervals.sum()
+            # One call for all three, so the array is only partitioned once
+            quartiles = numpy.percentile(intervals, [25, 50, 75])
+            stats.append((tot, intervals.min(), intervals.max(),
+                tot / intervals.size, *quartiles))
+    else:
+        packed = numpy.full((len(arrays), maxLen), numpy.nan)
+        for (i, intervals) in enumerate(arrays):
+            packed[i, :intervals.size] = intervals
+        # The NaN padding sorts to the end of each row
+        packed.sort(axis=1)
+        rows = numpy.arange(len(arrays))
+        tot = numpy.nansum(packed, axis=1)
+        minVal = packed[:, 0]
+        maxVal = packed[rows, lengths - 1]
+        meanVal = tot / lengths
+
+        # Interpolate the quartiles in the same way as numpy.percentile()
+        pos = numpy.array([[0.25], [0.5], [0.75]]) * (lengths - 1)
+        lower = numpy.floor(pos).astype(numpy.int64)
+        upper = numpy.minimum(lower + 1, lengths - 1)
+        lowerVal = packed[rows, lower]
+        quartiles = lowerVal + (packed[rows, upper] - lowerVal) * (pos - lower)
+        stats = list(zip(tot, minVal, maxVal, meanVal, *quartiles))
+    return stats
+
+
+# Held while the numba summary kernel runs. Its parallel region must not be
+# entered from two threads at once, as some of numba's threading layers
+# (e.g. workqueue, used when TBB and OpenMP are not available) abort the
+# whole process when that happens.
+summaryKernelLock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def getSummaryKernel():
+    """
+    Return a numba-compiled function to calculate summary statistics for
+    all timers at once, or None if numba is not available. It is called
+    as
+        stats = kernel(packed, offsets)
+    where packed is a single array of all the durations, concatenated,
+    and the durations for timer i are packed[offsets[i]:offsets[i + 1]].
+    It returns a 2-d array, with a row for each timer, whose columns are
+    as for the tuple returned by summarizeDurations().
+
+    The compiled function avoids the per-call overhead of numpy for each
+    separate statistic, which dominates when there are many timers. The
+    timers are shared between threads, running without the GIL, so this
+    also makes use of multiple cores when there are many timers. Calls to
+    it must hold summaryKernelLock.
+
+    Numba is slow to import, and is not otherwise required, so this is
+    only done the first time it is needed.
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    summarize = numba.njit(cache=True)(summarizeDurations)
+
+    @numba.njit(cache=True, parallel=True, nogil=True)
+    def summaryKernel(packed, offsets):
+        numTimers = offsets.size - 1
+        stats = numpy.empty((numTimers, 7))
+        for i in numba.prange(numTimers):
+            values = summarize(packed[offsets[i]:offsets[i + 1]])
+            for j in range(7):
+                stats[i, j] = values[j]
+        return stats
+
+    return summaryKernel
+
+
 class Timers:
     """
     Manage multiple named timers. See interval() method for example
     usage. The makeSummaryDict() method can be used to generate
     summary statistics on the timings.
 
-    Maintains a dictionary of pairs of start/finish times, before and
-    after particular operations. These are grouped by operation names,
-    and for each name, a list is accumulated of the pairs, for every
-    time when this operation was carried out.
+    Maintains a dictionary of the durations of particular operations,
+    measured from just before to just after each one. These are grouped by
+    operation names, and for each name, an array is accumulated of the
+    durations, for every time when this operation was carried out. The
+    durations are stored unboxed, as array.array('d'), so each costs only
+    8 bytes, and a million timed blocks use around 8 MB.
 
     The operation names are arbitrary strings chosen by the user at each
     point where a timer is embedded in the application code.
@@ -33,7 +247,10 @@ class Timers:
     contained with others.
 
     The object is thread-safe, so multiple threads can accumulate to
-    the same names. The object is also pickle-able.
+    the same names. Each thread accumulates into its own separate
+    buffers, so threads do not contend with each other in interval(),
+    and these are gathered together by collect(). The object is also
+    pickle-able.
 
     Example Usage::
 
@@ -65,12 +282,71 @@ class Timers:
     used to generate a report at the end of the application to present to a
     user, showing how the key parts of the application compare in time taken.
 
+    The clock argument selects how the time is read, see getClockFunc()
+    for details. The default is usually the right choice.
+
+    If samplingHz is given, the clock is not read directly by interval().
+    Instead, a background thread reads it samplingHz times per second,
+    and interval() just takes the most recent value stored by that thread
+    (see makeSampledClock()). This can reduce the overhead of each timed
+    block where reading the clock is expensive (e.g. some virtualised
+    systems), at the cost of resolution. The resolution is at best
+    1/samplingHz seconds, and if other threads are busy running Python
+    code, the sampling thread can be delayed for up to the interpreter's
+    switch interval (see sys.getswitchinterval()), so this works best
+    when there are spare cores. The thread stops when this object is
+    deleted.
+
     """
-    def __init__(self):
-        self.pairs = {}
+    def __init__(self, clock='perf', samplingHz=None):
+        self.durations = collections.defaultdict(
+            functools.partial(array.array, 'd'))
+        self.clock = clock
+        self.samplingHz = samplingHz
         self.lock = threading.Lock()
+        self._pool = []
+        self.setupThreadBuffers()
+        self.setupClock()
+
+    def setupThreadBuffers(self):
+        """
+        Create the per-thread storage used by interval(). Each thread
+        gets its own dictionary of durations, with the same structure as
+        self.durations, on its first use of interval().
+        """
+        self._local = threading.local()
+        # List of (thread, buffers) for every thread which has used
+        # interval(), so that collect() can find them. This has its own
+        # lock, so that a thread starting to time does not wait for
+        # self.lock, which is held during makeSummaryDict().
+        self._threadBuffers = []
+        self._threadBuffersLock = threading.Lock()
+
+    def newThreadBuffers(self):
+        """
+        Create and register the buffers for the current thread, and
+        return them.
+        """
+        buffers = collections.defaultdict(self.durations.default_factory)
+        with self._threadBuffersLock:
+            self._threadBuffers.append((threading.current_thread(),
+                buffers))
+        self._local.buffers = buffers
+        return buffers
+
+    def setupClock(self):
+        """
+        Create the function used by interval() to read the current time,
+        starting the sampling thread if required.
+        """
+        clockFunc = getClockFunc(self.clock)
+        if self.samplingHz is None:
+            self._now = clockFunc
+        else:
+            (self._now, stopEvent) = makeSampledClock(clockFunc,
+                self.samplingHz)
+            weakref.finalize(self, stopEvent.set)
 
-    @contextlib.contextmanager
     def interval(self, intervalName):
         """
         Use as a context manager to time a particular named interval.
@@ -82,27 +358,72 @@ class Timers:
                 # Code block required to perform the action
 
         After exit from the `with` statement, the timings object will have
-        accumulated the start and end times around the code block. These
-        will then contribute to the reporting of time intervals.
+        accumulated the time taken by the code block. This will then
+        contribute to the reporting of time intervals.
+
+        Times are taken from a monotonic clock (by default
+        time.perf_counter()), so intervals are unaffected by adjustments
+        to the system clock.
+
+        Each call returns a context manager to be used for a single
+        `with` statement, and using it again raises RuntimeError. These
+        are re-used once the block has finished, so that timing a tight
+        loop does not create a new object every time, and so must not be
+        kept after the `with` statement.
+
+        It can also be used as a decorator, to time every call to a
+        function::
+
+            @timings.interval('some_function')
+            def someFunction():
+                # Code to be timed on each call
 
         """
-        startTime = time.time()
-        yield
-        endTime = time.time()
-        with self.lock:
-            if intervalName not in self.pairs:
-                self.pairs[intervalName] = []
-            self.pairs[intervalName].append((startTime, endTime))
+        try:
+            ctx = self._pool.pop()
+        except IndexError:
+            ctx = _Interval(self)
+        try:
+            ctx.buffers = self._local.buffers
+        except AttributeError:
+            ctx.buffers = self.newThreadBuffers()
+        ctx.name = intervalName
+        ctx.entered = False
+        return ctx
+
+    def collect(self):
+        """
+        Move all durations accumulated by each thread's buffers into
+        self.durations. This is done by all the methods which report on
+        the durations, so is not usually required to be called directly.
+
+        Threads may continue timing while this is happening. Under
+        CPython, the owning thread can only append to its arrays while
+        they are being moved, so no durations are lost. Buffers for
+        threads which have finished are discarded once empty.
+        """
+        with self.lock, self._threadBuffersLock:
+            for (thread, buffers) in self._threadBuffers:
+                for name in list(buffers):
+                    arr = buffers[name]
+                    n = len(arr)
+                    self.durations[name].extend(arr[:n])
+                    del arr[:n]
+            # A finished thread cannot add more, so if its buffers are
+            # empty now, they are no longer needed
+            self._threadBuffers = [(thread, buffers)
+                for (thread, buffers) in self._threadBuffers
+                if thread.is_alive() or any(buffers.values())]
 
     def getDurationsForName(self, intervalName):
         """
-        For the given interval name, turns that list of start/end times
-        into a list of durations (end - start), in seconds.
-
-        Returns the list of durations.
+        For the given interval name, return a list of the durations
+        accumulated, in seconds. Returns None if there are none for that
+        name.
         """
-        if intervalName in self.pairs:
-            intervals = [(p[1] - p[0]) for p in self.pairs[intervalName]]
+        self.collect()
+        if intervalName in self.durations:
+            intervals = self.durations[intervalName].tolist()
         else:
             intervals = None
         return intervals
@@ -111,53 +432,183 @@ class Timers:
         """
         Merge another Timers object into this one
         """
+        other.collect()
         with self.lock:
-            for intervalName in other.pairs:
-                if intervalName in self.pairs:
-                    self.pairs[intervalName].extend(other.pairs[intervalName])
-                else:
-                    self.pairs[intervalName] = other.pairs[intervalName]
+            for intervalName in list(other.durations):
+                self.durations[intervalName].extend(
+                    other.durations[intervalName])
 
-    def makeSummaryDict(self):
+    def makeSummaryDict(self, useNumba=False):
         """
         Make some summary statistics, and return them in a dictionary
+
+        By default, the statistics are calculated with numpy. If useNumba
+        is True, and numba is available, a compiled kernel is used instead
+        (see getSummaryKernel()). This is only worthwhile when there are
+        very many timers or samples, and reports are made repeatedly, as
+        the first use pays for importing numba and compiling the kernel,
+        which takes seconds.
         """
         if numpy is None:
             print("Timers.makeSummaryDict() requires numpy")
             return
 
+        summaryKernel = None
+        if useNumba:
+            summaryKernel = getSummaryKernel()
+        self.collect()
+        # The arrays are viewed in place, without copying. The lock is held
+        # until the views are released, as collect() or merge() cannot
+        # resize an array while it is being viewed. interval() does not
+        # use this lock, so timing is not blocked.
+        with self.lock:
+            # Names with no durations (e.g. from just reading
+            # self.durations[name]) are left out, so the calculations
+            # never see an empty array
+            names = [name for name in self.durations
+                if len(self.durations[name]) > 0]
+            arrays = [numpy.frombuffer(self.durations[name],
+                dtype=numpy.float64) for name in names]
+            counts = [intervals.size for intervals in arrays]
+            if summaryKernel is None:
+                stats = summarizeDurationsNumpy(arrays)
+            else:
+                # This is a copy, so the kernel can run without the lock
+                packed = numpy.concatenate([numpy.empty(0)] + arrays)
+            del arrays
+
+        if summaryKernel is not None:
+            offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+            numpy.cumsum(counts, out=offsets[1:])
+            with summaryKernelLock:
+                stats = summaryKernel(packed, offsets)
+
         d = {}
-        for name in self.pairs:
-            intervals = numpy.array(self.getDurationsForName(name))
-            tot = float(intervals.sum())
-            minVal = float(intervals.min())
-            maxVal = float(intervals.max())
-            meanVal = float(intervals.mean())
-            pcnt25 = float(numpy.percentile(intervals, 25))
-            pcnt50 = float(numpy.percentile(intervals, 50))
-            pcnt75 = float(numpy.percentile(intervals, 75))
+        for (name, count, values) in zip(names, counts, stats):
+            (tot, minVal, maxVal, meanVal, pcnt25, pcnt50, pcnt75) = (
+                float(v) for v in values)
             d[name] = {'total': tot, 'min': minVal, 'max': maxVal,
                 'lowerq': pcnt25, 'median': pcnt50, 'upperq': pcnt75,
-                'mean': meanVal, 'count': len(intervals)}
+                'mean': meanVal, 'count': count}
         return d
 
     def __getstate__(self):
         """
-        Ensure pickleability by omitting the lock attribute
+        Ensure pickleability by omitting the lock, clock function and
+        per-thread attributes. Durations from all threads are collected
+        first.
+
+        The lock is only held while taking the list of names, and each
+        array of durations is then copied outside the lock. Under CPython,
+        each copy is atomic with respect to collect() appending to it.
         """
-        d = {}
+        self.collect()
         with self.lock:
-            d.update(self.__dict__)
+            d = dict(self.__dict__)
+            names = list(self.durations)
         d.pop('lock')
+        d.pop('_now')
+        d.pop('_pool')
+        d.pop('_local')
+        d.pop('_threadBuffers')
+        d.pop('_threadBuffersLock')
+        d['durations'] = collections.defaultdict(
+            self.durations.default_factory)
+        for name in names:
+            d['durations'][name] = self.durations[name][:]
         return d
 
     def __setstate__(self, state):
         """
-        For unpickling, add a new lock attribute
+        For unpickling, add a new lock attribute, and re-create the
+        clock function and the pool of interval context managers
+
+        Pickles from version 1.0.0 hold a dictionary of (start, end) pairs
+        for each name, which are converted to durations, and have no clock
+        settings, so these take their defaults.
         """
+        state = dict(state)
+        state.setdefault('clock', 'perf')
+        state.setdefault('samplingHz', None)
+        if 'pairs' in state:
+            durations = collections.defaultdict(
+                functools.partial(array.array, 'd'))
+            for (name, pairs) in state.pop('pairs').items():
+                durations[name].extend(end - start for (start, end) in pairs)
+            state['durations'] = durations
+
         self.lock = threading.Lock()
         with self.lock:
             self.__dict__.update(state)
+            self.setupClock()
+            self._pool = []
+        self.setupThreadBuffers()
+
+
+class _Interval:
+    """
+    The context manager returned by Timers.interval(). Once finished with,
+    it is returned to the owner's pool, to be re-used by a later call to
+    interval().
+
+    It refers to the owner's clock function and pool, and only holds a
+    weak reference to the owner itself, so that the pool does not make a
+    reference cycle back to the owner, and the owner is freed (and any
+    sampling thread stopped) as soon as it is deleted.
+
+    It can also be used as a function decorator, to time every call to
+    the function.
+    """
+    __slots__ = ('now', 'pool', 'ownerRef', 'buffers', 'name', 'entered',
+        'startTime')
+
+    def __init__(self, owner):
+        self.now = owner._now
+        self.pool = owner._pool
+        self.ownerRef = weakref.ref(owner)
+        self.buffers = None
+        self.name = None
+        self.entered = False
+        self.startTime = None
+
+    def __enter__(self):
+        # It may only be used once per call to interval(), otherwise it
+        # would be returned to the pool twice, and then handed out to two
+        # intervals at once
+        if self.entered:
+            raise RuntimeError("The context manager returned by "
+                "Timers.interval() cannot be re-used")
+        self.entered = True
+        self.startTime = self.now()
+
+    def __call__(self, func):
+        """
+        Decorate func, so that each call is timed under this name. Each
+        call takes a new context manager from the owner's interval(), as
+        this one is returned to the pool straight away. The decorated
+        function holds a strong reference to the owner.
+        """
+        owner = self.ownerRef()
+        name = self.name
+        # Mark as used, so it cannot then be entered as well
+        self.entered = True
+        self.pool.append(self)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with owner.interval(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            endTime = self.now()
+            # No lock is taken here, as the buffers belong to the current
+            # thread. Under CPython, the array.append() is atomic with
+            # respect to the owner's collect() moving the contents.
+            self.buffers[self.name].append(endTime - self.startTime)
+        self.pool.append(self)
 
 
 class AllTests(unittest.TestCase):
@@ -199,6 +650,246 @@ class AllTests(unittest.TestCase):
         self.assertAlmostEqual(summ['test1']['total'], 3, places=self.places)
         self.assertAlmostEqual(summ['test2']['total'], 2, places=self.places)
 
+    def test_coarse(self):
+        t = Timers(clock='coarse')
+        with t.interval('test1'):
+            time.sleep(1)
+        summ = t.makeSummaryDict()
+        # The coarse clock only has a resolution of a few milliseconds
+        self.assertAlmostEqual(summ['test1']['total'], 1, places=1)
+
+    def test_sampled(self):
+        t = Timers(samplingHz=1000)
+        with t.interval('test1'):
+            time.sleep(1)
+        summ = t.makeSummaryDict()
+        self.assertAlmostEqual(summ['test1']['total'], 1, places=self.places)
+
+    def test_exception(self):
+        t = Timers()
+        with self.assertRaises(ValueError):
+            with t.interval('test1'):
+                raise ValueError()
+        with t.interval('test1'):
+            time.sleep(1)
+        summ = t.makeSummaryDict()
+        self.assertEqual(summ['test1']['count'], 1)
+        self.assertAlmostEqual(summ['test1']['total'], 1, places=self.places)
+
+    def test_samplingHz(self):
+        for samplingHz in (0, -10):
+            with self.assertRaises(ValueError):
+                Timers(samplingHz=samplingHz)
+
+        # The object is freed as soon as it is deleted, without waiting
+        # for the cyclic garbage collector, so the sampling thread stops
+        t = Timers(samplingHz=1000)
+        with t.interval('test1'):
+            pass
+        ref = weakref.ref(t)
+        gc.disable()
+        try:
+            del t
+            self.assertIsNone(ref())
+        finally:
+            gc.enable()
+
+    def test_decorator(self):
+        t = Timers()
+
+        @t.interval('test1')
+        def func(x):
+            time.sleep(0.5)
+            return x * 2
+
+        self.assertEqual(func(1), 2)
+        self.assertEqual(func(2), 4)
+        self.assertEqual(func.__name__, 'func')
+        summ = t.makeSummaryDict()
+        self.assertEqual(summ['test1']['count'], 2)
+        self.assertAlmostEqual(summ['test1']['total'], 1, places=self.places)
+
+    def test_reuse(self):
+        t = Timers()
+        ctx = t.interval('test1')
+        with ctx:
+            pass
+        with self.assertRaises(RuntimeError):
+            with ctx:
+                pass
+
+        # The context manager was only returned to the pool once, so these
+        # get separate ones
+        with t.interval('test2'):
+            time.sleep(1)
+            with t.interval('test3'):
+                time.sleep(0.5)
+        summ = t.makeSummaryDict()
+        self.assertEqual(summ['test1']['count'], 1)
+        self.assertEqual(summ['test2']['count'], 1)
+        self.assertAlmostEqual(summ['test2']['total'], 1.5, places=self.places)
+        self.assertEqual(summ['test3']['count'], 1)
+        self.assertAlmostEqual(summ['test3']['total'], 0.5, places=self.places)
+
+    def test_threads(self):
+        t = Timers()
+
+        def worker():
+            for i in range(1000):
+                with t.interval('test1'):
+                    pass
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thrd in threads:
+            thrd.start()
+        for thrd in threads:
+            thrd.join()
+        summ = t.makeSummaryDict()
+        self.assertEqual(summ['test1']['count'], 4000)
+
+    def test_stats(self):
+        t = Timers()
+        vals = [0.5, 3.0, 1.5, 0.25, 2.0, 1.0, 4.0]
+        t.durations['test1'].extend(vals)
+        (q25, q50, q75) = numpy.percentile(vals, [25, 50, 75])
+        for useNumba in (False, True):
+            summ = t.makeSummaryDict(useNumba=useNumba)['test1']
+            self.assertEqual(summ['count'], len(vals))
+            self.assertAlmostEqual(summ['total'], sum(vals))
+            self.assertAlmostEqual(summ['min'], min(vals))
+            self.assertAlmostEqual(summ['max'], max(vals))
+            self.assertAlmostEqual(summ['mean'], sum(vals) / len(vals))
+            self.assertAlmostEqual(summ['lowerq'], q25)
+            self.assertAlmostEqual(summ['median'], q50)
+            self.assertAlmostEqual(summ['upperq'], q75)
+
+    def test_empty(self):
+        t = Timers()
+        t.durations['test1'].extend([1.0, 2.0])
+        t.durations['test2']
+        t.durations['test3'].extend([3.0])
+        for useNumba in (False, True):
+            summ = t.makeSummaryDict(useNumba=useNumba)
+            self.assertNotIn('test2', summ)
+            self.assertEqual(summ['test1']['total'], 3.0)
+            self.assertEqual(summ['test3']['total'], 3.0)
+            self.assertEqual(summ['test3']['median'], 3.0)
+
+    def test_emptyKernel(self):
+        summaryKernel = getSummaryKernel()
+        if summaryKernel is None:
+            self.skipTest("numba not available")
+        packed = numpy.array([1.0, 2.0, 3.0])
+        offsets = numpy.array([0, 2, 2, 3])
+        with summaryKernelLock:
+            stats = summaryKernel(packed, offsets)
+        self.assertEqual(stats[0, 0], 3.0)
+        self.assertEqual(stats[1, 0], 0.0)
+        self.assertTrue(numpy.isnan(stats[1, 1:]).all())
+        self.assertEqual(stats[2, 0], 3.0)
+        self.assertEqual(stats[2, 5], 3.0)
+
+    def test_statsNumpy(self):
+        # Similar lengths, so packed into one array, and then very
+        # different lengths, so done separately
+        for lengths in [(5, 6, 7, 1), (1, 2, 100)]:
+            arrays = [numpy.random.rand(n) for n in lengths]
+            stats = summarizeDurationsNumpy(arrays)
+            for (intervals, values) in zip(arrays, stats):
+                quartiles = numpy.percentile(intervals, [25, 50, 75])
+                expected = (intervals.sum(), intervals.min(),
+                    intervals.max(), intervals.mean(), *quartiles)
+                for (val, exp) in zip(values, expected):
+                    self.assertAlmostEqual(val, exp)
+
+    def test_newThreadDuringSummary(self):
+        # A thread's first interval() must not wait for self.lock, which
+        # is held while makeSummaryDict() is calculating
+        t = Timers()
+
+        def worker():
+            with t.interval('test1'):
+                pass
+
+        with t.lock:
+            thrd = threading.Thread(target=worker)
+            thrd.start()
+            thrd.join(5)
+            self.assertFalse(thrd.is_alive())
+        self.assertEqual(t.makeSummaryDict()['test1']['count'], 1)
+
+    def test_legacyPickle(self):
+        # The state as pickled by version 1.0.0
+        state = {'pairs': {'test1': [(10.0, 11.0), (20.0, 22.5)]}}
+        t = Timers.__new__(Timers)
+        t.__setstate__(state)
+        summ = t.makeSummaryDict()
+        self.assertEqual(summ['test1']['count'], 2)
+        self.assertAlmostEqual(summ['test1']['total'], 3.5)
+        with t.interval('test2'):
+            pass
+        self.assertEqual(t.makeSummaryDict()['test2']['count'], 1)
+
+    def test_kernelThreads(self):
+        if getSummaryKernel() is None:
+            self.skipTest("numba not available")
+        # Summarize from several threads at once, with the threading layer
+        # which aborts the process on concurrent use, so this is run in a
+        # separate process
+        script = """if True:
+            import threading
+            import timinghooks
+            timersList = []
+            for i in range(4):
+                t = timinghooks.Timers()
+                for j in range(50):
+                    t.durations[j].extend([0.001 * k for k in range(500)])
+                timersList.append(t)
+
+            def worker(t):
+                for k in range(20):
+                    t.makeSummaryDict(useNumba=True)
+
+            threads = [threading.Thread(target=worker, args=(t,))
+                for t in timersList]
+            for thrd in threads:
+                thrd.start()
+            for thrd in threads:
+                thrd.join()
+            """
+        env = dict(os.environ, NUMBA_THREADING_LAYER='workqueue',
+            NUMBA_NUM_THREADS='4')
+        env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+        proc = subprocess.run([sys.executable, '-c', script], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode())
+
+    def test_merge(self):
+        t1 = Timers()
+        t2 = Timers()
+        with t1.interval('test1'):
+            time.sleep(1)
+        with t2.interval('test1'):
+            time.sleep(1)
+        with t2.interval('test2'):
+            time.sleep(0.5)
+        t1.merge(t2)
+        summ = t1.makeSummaryDict()
+        self.assertAlmostEqual(summ['test1']['total'], 2, places=self.places)
+        self.assertEqual(summ['test1']['count'], 2)
+        self.assertAlmostEqual(summ['test2']['total'], 0.5, places=self.places)
+
+    def test_pickle(self):
+        t = Timers()
+        with t.interval('test1'):
+            time.sleep(1)
+        t2 = pickle.loads(pickle.dumps(t))
+        with t2.interval('test1'):
+            time.sleep(1)
+        summ = t2.makeSummaryDict()
+        self.assertAlmostEqual(summ['test1']['total'], 2, places=self.places)
+        self.assertEqual(summ['test1']['count'], 2)
+
 
 def mainCmd():
     unittest.main(module='timinghooks')